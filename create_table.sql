@@ -18,9 +18,9 @@ CREATE TABLE daily_mycap (
   LAT VARCHAR(30) NOT NULL,
   LON VARCHAR(30) NOT NULL,
   DT TIMESTAMP NOT NULL,
-  AQI_CURRENT INT,
-  AQI_TODAY INT,
-  AQI_NEXT_DAY INT
+  AQI_CURRENT SMALLINT,
+  AQI_TODAY SMALLINT,
+  AQI_NEXT_DAY SMALLINT
 );
 
 SELECT * FROM students;
@@ -1,35 +1,98 @@
+import asyncio
+import atexit
 import datetime
+import glob
+import hashlib
 import logging
-import requests
-import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import os
+import queue
 from typing import Tuple
 
 
 import pandas as pd
 from pandas import errors
 import numpy as np
+import aiohttp
+from aiolimiter import AsyncLimiter
 import mysql.connector
+from numba import njit, prange
+import orjson
 from mysql.connector import errorcode
 import sqlalchemy
 from sqlalchemy import create_engine
 
 
+# Log records are handed to a queue and written to file by a background thread, so logging never blocks the event loop.
+# The file rotates at midnight into logs/<date>_log.log, so a long-lived scheduled process still logs one file per day
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+os.makedirs(LOG_DIR, exist_ok=True)
+_log_queue = queue.Queue(-1)
+_log_file_handler = TimedRotatingFileHandler(os.path.join(LOG_DIR, 'extraction.log'), when='midnight', delay=True)
+_log_file_handler.namer = lambda name: os.path.join(LOG_DIR, f'{name.rsplit(".", 1)[-1]}_log.log')
+_log_file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+
+# Daily snapshots of the students list, see DataExtractor._get_student_dict
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# PM 2.5 AQI breakpoints, one entry per AQI category
+C_LOW = np.array([0.0, 9.1, 35.5, 55.5, 125.5, 225.5])
+C_HIGH = np.array([9.0, 35.4, 55.4, 125.4, 225.4, 5000.0])
+I_LOW = np.array([0, 51, 101, 151, 201, 301])
+I_HIGH = np.array([50, 100, 150, 200, 300, 500])
+SLOPE = (I_HIGH - I_LOW) / (C_HIGH - C_LOW)
+
+OWM_URLS = {'current_air': 'http://api.openweathermap.org/data/2.5/air_pollution',
+            'forecast_air': 'http://api.openweathermap.org/data/2.5/air_pollution/forecast'}
+
+# Number of hourly OWM forecast entries averaged for each of today and the next day
+FC_HOURS = 23
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _calculate_aqi_arr(conc: np.ndarray, out: np.ndarray) -> None:
+    """
+    Fused kernel writing the AQI of each PM 2.5 concentration in the flat array conc into out
+    """
+    for i in prange(conc.size):
+        c = conc[i]
+        j = 0
+        while j < C_HIGH.size - 1 and c > C_HIGH[j]:
+            j += 1
+        out[i] = SLOPE[j] * (c - C_LOW[j]) + I_LOW[j]
+
+
 class DataExtractor():
     def __init__(self, configs) -> None:
         self.configs = configs
-        logging.basicConfig(level=logging.INFO, 
-                                          filename=f'logs/{str(datetime.datetime.now().date())}_log.log',
-                                          filemode="w", 
-                                          format="%(asctime)s %(levelname)s %(message)s")
         self.logger = logging.getLogger('main_logger')
 
         self.db, self.sqlach_engine = self._connect_db()
-        self.students_dict = self._get_student_dict()
 
+        # Populated for each extraction run by refresh()
+        self.students_dict = {}
         self.rt_error_list = []
         self.fc_error_list = []
 
+        # Token bucket pacing every OWM request to the configured requests per minute
+        self.limiter = AsyncLimiter(self.configs['main']['owm_rpm'], 60)
+
         
+    def refresh(self) -> None:
+        """
+        This method prepares the extractor for a new extraction run. It revives the DB connection if it was dropped
+        while idle, reloads the most current list of survey participants and clears the previous run's error lists
+        """
+        self.db.ping(reconnect=True)
+        self.students_dict = self._get_student_dict()
+        self.rt_error_list = []
+        self.fc_error_list = []
+
     
     def _connect_db(self):
         """
@@ -74,7 +137,8 @@ class DataExtractor():
         # MySQL conection string.
         connstr = 'mysql+mysqlconnector://{user}:{pwd}@{host}:{port}/{db}'
 
-        sqlach_engine = create_engine(connstr.format(**creds))
+        # Pooled connections are kept across scheduled runs; pre-ping and recycle drop the ones MySQL timed out
+        sqlach_engine = create_engine(connstr.format(**creds), pool_size=5, pool_pre_ping=True, pool_recycle=3600)
 
 
         return mydb, sqlach_engine
@@ -84,108 +148,178 @@ class DataExtractor():
     def _get_student_dict(self) -> dict:
         """
         This internal method queries the most current list survey participants and their registered coordinates
-        from HUPH's DB 
+        from HUPH's DB. The result is snapshotted to a parquet file keyed by the date and a hash of the students query,
+        which is read instead of the DB on later runs. Older snapshots are removed when a new one is written
 
         Returns:
         A dictionary of survey participants containing their latest registered coordinates
         """
-        students_df = pd.read_sql(self.configs['sql_queries']['students'],
-                                  con=self.sqlach_engine)
-        
-        if len(students_df) < 1:
-            self.logger.error(errors.EmptyDataError('DataFrame is empty'))
-            raise errors.EmptyDataError('DataFrame is empty')
+        query = self.configs['sql_queries']['students']
+        query_hash = hashlib.sha1(query.encode()).hexdigest()[:12]
+        cache_path = os.path.join(CACHE_DIR, f'students_{str(datetime.datetime.now().date())}_{query_hash}.parquet')
+
+        try:
+            students_df = pd.read_parquet(cache_path)
+            self.logger.info(f'Loaded students from snapshot {cache_path}')
+        except FileNotFoundError:
+            students_df = pd.read_sql(query, con=self.sqlach_engine)
+            
+            if len(students_df) < 1:
+                self.logger.error(errors.EmptyDataError('DataFrame is empty'))
+                raise errors.EmptyDataError('DataFrame is empty')
 
-        students_df = students_df[students_df['DT'].dt.date == students_df['DT'].dt.date.max()]
+            for old_path in glob.glob(os.path.join(CACHE_DIR, 'students_*.parquet')):
+                os.remove(old_path)
+            students_df.to_parquet(cache_path, index=False)
         
-        return students_df.set_index('STUDENT_ID').T.to_dict('dict')
+        return {sid: {'LAT': float(lat), 'LON': float(lon)}
+                for sid, lat, lon in zip(students_df['STUDENT_ID'].tolist(),
+                                         students_df['LAT'].tolist(),
+                                         students_df['LON'].tolist())}
     
 
-    def _extract_from_owm(self, student_id:int, request_type: str) -> dict:
+    def _plan_cells(self, student_ids: list) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        This internal method finds the distinct coordinate cells that survey participants' registered coordinates
+        fall into, so that OWM is only queried once per cell
+
+        Parameters:
+        student_ids: the list of student ids of survey participants
+
+        Returns:
+        cells: A (n_cells, 2) array of the distinct rounded (lat, lon) cells
+        inv: The index into cells of each student in student_ids
+        """
+        coords = np.array([[self.students_dict[id]['LAT'], self.students_dict[id]['LON']] for id in student_ids],
+                          dtype=np.float64).reshape(-1, 2)
+        cells, inv = np.unique(np.round(coords, self.configs['main']['coord_decimals']), axis=0, return_inverse=True)
+
+        return cells, inv.ravel()
+    
+
+    @staticmethod
+    def _cell_rows(n_cells: int, ok_cells: list, inv: np.ndarray) -> np.ndarray:
+        """
+        An internal static method which maps each student to the row of its cell among the cells whose 
+        OWM request succeeded
+
+        Parameters:
+        n_cells: The number of cells in the fetch plan
+        ok_cells: The indices of the cells whose OWM request succeeded, in the order of the extracted rows
+        inv: The index of each student's cell, see _plan_cells
+
+        Returns:
+        The row of each student's cell among ok_cells, or -1 if the request for its cell failed
+        """
+        rows = np.full(n_cells, -1)
+        rows[ok_cells] = np.arange(len(ok_cells))
+
+        return rows[inv]
+
 
+    def _build_urls(self, cells: list, request_type: str) -> list:
         """
-        This internal method uses a pair of latitude and longitude to extract from OWM either 
+        This internal method precomputes the OWM request urls for a list of coordinate cells, for either
         1) the current air pollution concentrations and 
         2) the air pollution forecasts 
 
         Parameters:
-        student_id: The survey participant's student id
+        cells: The list of rounded (lat, lon) coordinate cells
         request_type: The type of API request to OWM, can be either 
                             1) current air pollution or 2) forecasted air pollution
-        
-        Returns:
-        r_json: A dictionary containing the API response 
 
+        Returns:
+        urls: The list of OWM request urls, in the same order as cells
         """
+        if request_type not in OWM_URLS:
+            self.logger.error('Wrong request type. Should be either "current_air" pr "forecast_air"!')
+            raise ValueError('Wrong request type. Should be either "current_air" pr "forecast_air"!')
 
+        base = OWM_URLS[request_type]
         api_key = self.configs['credentials']['owm_api_key']
-        lat = self.students_dict[student_id]['LAT']
-        lon = self.students_dict[student_id]['LON']
 
-        if request_type == 'current_air':
-            url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={api_key}'
-        elif request_type == 'forecast_air':
-            url = f'http://api.openweathermap.org/data/2.5/air_pollution/forecast?lat={lat}&lon={lon}&appid={api_key}'
-        else:
-            self.logger.error('Wrong request type. Should be either "current_air" pr "forecast_air"!')
-            raise ValueError('Wrong request type. Should be either "current_air" pr "forecast_air"!')
+        return [f'{base}?lat={lat}&lon={lon}&appid={api_key}' for lat, lon in cells]
+
+
+    async def _extract_from_owm(self, url: str, session: aiohttp.ClientSession) -> dict:
+
+        """
+        This internal method sends a prebuilt request url to OWM and returns the fields of the response
+        selected by _select_fields. Rate limited (429) requests are retried after OWM's Retry-After delay and server errors (5xx) with exponential backoff
+
+        Parameters:
+        url: The OWM request url, see _build_urls
+        session: The aiohttp client session shared by the concurrent requests
         
-        r = requests.get(url)
-        while r.status_code == 429:
-            self.logger.warning("OWM minute quota reached, delay for 60s")
-            time.sleep(60)
-            self.logger.info("Retrying OWM GET request")
-            r = requests.get(url)
+        Returns:
+        r_json: A dictionary containing the selected fields of the API response 
 
-        r_json = r.json()
-        r_json['STUDENT_ID'] = student_id
+        """
+        max_retries = self.configs['main']['owm_max_retries']
+        for attempt in range(max_retries + 1):
+            async with self.limiter:
+                async with session.get(url) as r:
+                    if r.status == 429 or r.status >= 500:
+                        if attempt == max_retries:
+                            r.raise_for_status()
+                        if r.status == 429:
+                            # Wait as long as OWM asks, falling back to 10s if it does not say
+                            retry_after = r.headers.get('Retry-After', '')
+                            delay = int(retry_after) if retry_after.isdigit() else 10
+                            self.logger.warning(f"OWM minute quota reached, delay for {delay}s")
+                        else:
+                            delay = 2 ** attempt
+                            self.logger.warning(f"OWM returned status {r.status}, delay for {delay}s")
+                    else:
+                        # Other client errors (bad key, bad coordinates, ...) are not retried
+                        r.raise_for_status()
+                        r_json = self._select_fields(orjson.loads(await r.read()))
+                        break
+            await asyncio.sleep(delay)
+            self.logger.info("Retrying OWM GET request")
 
         return r_json
     
     @staticmethod
-    def _format_concentration(df: pd.DataFrame, type: str) -> pd.DataFrame:
+    def _select_fields(r_json: dict) -> dict:
         """
-        An internal static method which processes values of various PM 2.5 aggregations to the 
-        appropriate demical points to be used to compute the corresponding AQI values
-        https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf 
+        An internal static method which keeps only the fields of an OWM air pollution response that are used
+        to compute AQI, so that the full hourly entries are not kept alive while the other requests are gathered
 
         Parameters:
-        df: The pandas dataframe containing the PM 2.5 aggregations
-        type: The type of the aggregations contained within df. Can be either
-              1) current
-              2) forecast
+        r_json: The parsed OWM air pollution response
 
         Returns:
-        df: The processed PM 2.5 dataframe  
-
+        A dictionary with the timestamps (dt) and PM 2.5 concentrations (pm25) of the response's first 
+        2 * FC_HOURS entries. dt and pm25 are None if OWM returned no entries
         """
-        if type == 'current':
-            df['PM25'] = np.round(df['PM25'], 1)
-        if type == 'forecast':
-            df['PM25_TODAY'] = np.round(df['PM25_TODAY'], 1)
-            df['PM25_NEXT_DAY'] = np.round(df['PM25_NEXT_DAY'], 1)
+        entries = r_json['list']
+        if entries is not None:
+            entries = entries[:2 * FC_HOURS]
+
+        return {'dt': None if entries is None else [x['dt'] for x in entries],
+                'pm25': None if entries is None else [x['components']['pm2_5'] for x in entries]}
 
-        return df
-    
     @staticmethod
-    def _calculate_aqi(concentration: float) -> float:
+    def _calculate_aqi(concentration: np.ndarray) -> np.ndarray:
         """
-        This internal static method computes the AQI value of the input PM2.5 concentration. Uses AQI breakpoints found in:
+        This internal static method computes the AQI values of an array of PM2.5 concentrations. Uses AQI breakpoints found in:
         https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf 
 
         Parameters:
-        concentration: the input PM 2.5 concentration
+        concentration: the array of input PM 2.5 concentrations
 
         Returns: 
-        The computed AQI value
+        The array of computed AQI values
         """
-        breakpoints_pm25 = [(0, 50, 0.0, 9.0), (51, 100, 9.1, 35.4), (101, 150, 35.5, 55.4), (151, 200, 55.5, 125.4), (201, 300, 125.5, 225.4), (301, 500, 225.5 , 5000)]
-        for (I_low, I_high, C_low, C_high) in breakpoints_pm25:
-            if C_low <= concentration <= C_high:
-                return (I_high - I_low) / (C_high - C_low) * (concentration - C_low) + I_low
+        concentration = np.ascontiguousarray(concentration, dtype=np.float64)
+        out = np.empty_like(concentration)
+        _calculate_aqi_arr(concentration.ravel(), out.ravel())
+
+        return out
             
 
-    def get_rt(self, student_ids: list):
+    async def get_rt(self, student_ids: list):
         """
         This method takes the list of survey partcipants by their student ids and computes the corresponding current AQI.
         The results are encapsulated in a pandas dataframe
@@ -196,45 +330,54 @@ class DataExtractor():
         Returns:
         df_rt: The pandas dataframe containing the survey participants' current AQI values.
         """        
-        dfs = []
-
-        for id in student_ids:
-            r_air = self._extract_from_owm(id, request_type='current_air')
-
-            if r_air['list'] is not None:
-                pm25 = [r_air['list'][0]['components']['pm2_5']]
-                dt = [r_air['list'][0]['dt']]
-                
-                df = pd.DataFrame({'STUDENT_ID': r_air['STUDENT_ID'],
-                                'LAT': r_air['coord']['lat'],
-                                'LON': r_air['coord']['lon'],
-                                'DT_UNIX': dt,
-                                'PM25': pm25})
-
-                dfs.append(df)
+        ok_cells = []
+        dt_list = []
+        pm25_list = []
+
+        cells, inv = self._plan_cells(student_ids)
+
+        urls = self._build_urls(cells.tolist(), 'current_air')
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50)) as session:
+            tasks = [self._extract_from_owm(url, session) for url in urls]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for k, r_air in enumerate(results):
+            if isinstance(r_air, Exception):
+                ids = [student_ids[i] for i in np.flatnonzero(inv == k)]
+                self.logger.error(f'Current air request failed for student_ids {ids}: {r_air}')
+            elif r_air['pm25']:
+                ok_cells.append(k)
+                dt_list.append(r_air['dt'][0])
+                pm25_list.append(r_air['pm25'][0])
             else:
-                self.logger.error(f'No current air information extracted for student_id {id}')
-                self.rt_error_list.append(id)
-
-        if len(dfs) > 0:
-            df_rt = pd.concat(dfs, axis=0).reset_index(drop=True)
-
-            df_rt['DT'] = pd.to_datetime(df_rt['DT_UNIX'],unit='s')
-            df_rt['DT'] = df_rt['DT'].dt.tz_localize('UTC').dt.tz_convert('Asia/Ho_Chi_Minh')
-
-            df_rt = df_rt.drop(['DT_UNIX'], axis=1)
-            df_rt = df_rt[['STUDENT_ID', 'LAT', 'LON', 'DT', 'PM25']]
-
-            df_rt = self._format_concentration(df_rt, 'current')
-            df_rt['AQI_CURRENT'] = np.round(df_rt['PM25'].apply(lambda x: self._calculate_aqi(x)), 0)
-            df_rt['AQI_CURRENT'] = df_rt['AQI_CURRENT'].astype(int)
+                ids = [student_ids[i] for i in np.flatnonzero(inv == k)]
+                self.logger.error(f'No current air information extracted for student_ids {ids}')
+
+        rows = self._cell_rows(len(cells), ok_cells, inv)
+        served = rows >= 0
+        self.rt_error_list.extend(id for id, ok in zip(student_ids, served) if not ok)
+
+        if served.any():
+            # Computed once per cell, then gathered for every student in it; coordinates stay the student's own
+            rows = rows[served]
+            served_ids = np.asarray(student_ids, dtype=object)[served]
+            pm25 = np.round(np.asarray(pm25_list), 1)
+            aqi = np.round(self._calculate_aqi(pm25)).astype(np.int16)
+
+            df_rt = pd.DataFrame({'STUDENT_ID': served_ids,
+                                  'LAT': [self.students_dict[id]['LAT'] for id in served_ids],
+                                  'LON': [self.students_dict[id]['LON'] for id in served_ids],
+                                  'DT': pd.to_datetime(np.asarray(dt_list)[rows], unit='s', utc=True).tz_convert(self.configs['main']['timezone']),
+                                  'PM25': pm25[rows],
+                                  'AQI_CURRENT': aqi[rows]})
         
             return df_rt
         else:
             return 
 
 
-    def get_fc(self, student_ids: list) -> pd.DataFrame:
+    async def get_fc(self, student_ids: list) -> pd.DataFrame:
         """
         This method takes the list of survey partcipants by their student ids and computes the corresponding forecasted mean daily AQI of the current and next day.
         The results are encapsulated in a pandas dataframe
@@ -245,48 +388,44 @@ class DataExtractor():
         Returns:
         df_fc: The pandas dataframe containing the survey participants' forecasted and averaged AQI values.
         """      
-        dfs = [] 
-        for id in student_ids:
+        ok_cells = []
+        pm25_list = []
 
-            r_forecast = self._extract_from_owm(id, request_type='forecast_air')
+        cells, inv = self._plan_cells(student_ids)
 
-            if r_forecast['list'] is not None:
-                pm25_today = [x['components']['pm2_5'] for x in r_forecast['list'][:23]]
-                dt_today = [x['dt'] for x in r_forecast['list'][:23]]
+        urls = self._build_urls(cells.tolist(), 'forecast_air')
 
-                pm25_next_day = [x['components']['pm2_5'] for x in r_forecast['list'][23:46]]
-                dt_next_day = [x['dt'] for x in r_forecast['list'][23:46]]
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50)) as session:
+            tasks = [self._extract_from_owm(url, session) for url in urls]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
 
-                df = pd.DataFrame({'STUDENT_ID': r_forecast['STUDENT_ID'],
-                                    'LAT': r_forecast['coord']['lat'],
-                                    'LON': r_forecast['coord']['lon'],
-                                    'DT_TODAY': dt_today,
-                                    'PM25_TODAY': pm25_today,
-                                    'DT_NEXT_DAY': dt_next_day,
-                                    'PM25_NEXT_DAY': pm25_next_day})
-                
-                dfs.append(df)
+        for k, r_forecast in enumerate(results):
+            if isinstance(r_forecast, Exception):
+                ids = [student_ids[i] for i in np.flatnonzero(inv == k)]
+                self.logger.error(f'Forecast air request failed for student_ids {ids}: {r_forecast}')
+            elif r_forecast['pm25'] is not None and len(r_forecast['pm25']) >= 2 * FC_HOURS:
+                ok_cells.append(k)
+                pm25_list.append(r_forecast['pm25'][:2 * FC_HOURS])
             else:
-                self.logger.error(f'No forecast air information extracted for student_id {id}')
-                self.fc_error_list.append(id)
+                ids = [student_ids[i] for i in np.flatnonzero(inv == k)]
+                self.logger.error(f'No forecast air information extracted for student_ids {ids}')
 
-        if len(dfs) > 0:
-            df_fc = pd.concat(dfs, axis=0).reset_index(drop=True)
+        rows = self._cell_rows(len(cells), ok_cells, inv)
+        served = rows >= 0
+        self.fc_error_list.extend(id for id, ok in zip(student_ids, served) if not ok)
 
-            df_fc['DT_TODAY'] = pd.to_datetime(df_fc['DT_TODAY'],unit='s')
-            df_fc['DT_TODAY'] = df_fc['DT_TODAY'].dt.tz_localize('UTC').dt.tz_convert('Asia/Ho_Chi_Minh')
-            df_fc['DT_NEXT_DAY'] = pd.to_datetime(df_fc['DT_NEXT_DAY'],unit='s')
-            df_fc['DT_NEXT_DAY'] = df_fc['DT_NEXT_DAY'].dt.tz_localize('UTC').dt.tz_convert('Asia/Ho_Chi_Minh')
+        if served.any():
+            # Each cell contributes exactly FC_HOURS entries for today followed by FC_HOURS for the next day
+            rows = rows[served]
+            aqi = np.round(self._calculate_aqi(np.round(np.asarray(pm25_list), 1)))
 
-            df_fc = self._format_concentration(df_fc, 'forecast')
-            df_fc['AQI_TODAY'] = np.round(df_fc['PM25_TODAY'].apply(lambda x: self._calculate_aqi(x)), 0)
-            df_fc['AQI_NEXT_DAY'] = np.round(df_fc['PM25_NEXT_DAY'].apply(lambda x: self._calculate_aqi(x)), 0)
+            aqi_today = np.round(aqi[:, :FC_HOURS].mean(axis=1)).astype(np.int16)
+            aqi_next_day = np.round(aqi[:, FC_HOURS:].mean(axis=1)).astype(np.int16)
 
-            df_fc = df_fc.groupby(['STUDENT_ID', 'LAT', 'LON']).agg({'AQI_TODAY': 'mean', 
-                                                                    'AQI_NEXT_DAY': 'mean'}).reset_index()
-            df_fc['AQI_TODAY'] = np.round(df_fc['AQI_TODAY']).astype(int)
-            df_fc['AQI_NEXT_DAY'] = np.round(df_fc['AQI_NEXT_DAY']).astype(int)
+            df_fc = pd.DataFrame({'STUDENT_ID': np.asarray(student_ids, dtype=object)[served],
+                                  'AQI_TODAY': aqi_today[rows],
+                                  'AQI_NEXT_DAY': aqi_next_day[rows]})
 
-            return df_fc[['STUDENT_ID', 'AQI_TODAY', 'AQI_NEXT_DAY']]
+            return df_fc
         else:
-            return
\ No newline at end of file
+            return
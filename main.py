@@ -1,59 +1,81 @@
+import asyncio
+import functools
 import json
 import os
 import sys
 import time
 
 import schedule
+import numpy as np
 import pandas as pd
 
 sys.path.append(os.getcwd())
 from data_extractor import DataExtractor
-from utils import separate_into_breakpoints
 
 
 with open('configs.json', 'r') as f:
     CONFIGS = json.load(f)
 
-def main():
 
-    extractor = DataExtractor(CONFIGS)
+@functools.lru_cache(maxsize=None)
+def get_extractor() -> DataExtractor:
+    # Built once and reused by every scheduled run to keep its DB connections and rate limiter
+    return DataExtractor(CONFIGS)
+
+
+async def main_async():
+
+    extractor = get_extractor()
+    extractor.refresh()
 
     t0 = time.time()
     
     extractor.logger.info(f'Extraction started on {t0}')
 
-    # find break points to avoid exceeding OWM's api quota
     student_ids = list(extractor.students_dict.keys())
-    breakpoints = separate_into_breakpoints(len(student_ids), step=CONFIGS['main']['breakpoint_steps'])
     
     extractor.logger.info("Begin extraction & AQI calculations")
-    dfs_rt = []
-    dfs_fc = []
-    for i in range(len(breakpoints)-1):
-        if len(student_ids) <= CONFIGS['main']['breakpoint_steps']:
-            student_chunks = student_ids
-        else:
-            student_chunks = student_ids[breakpoints[i]:breakpoints[i+1]]
-        dfs_rt.append(extractor.get_rt(student_chunks))
-        dfs_fc.append(extractor.get_fc(student_chunks))
-        if len(student_ids) > CONFIGS['main']['breakpoint_steps']:
-            time.sleep(60)
-
-    extractor.logger.info("Concatenating DataFrames")
-    rt = pd.concat(dfs_rt, axis=0).reset_index(drop=True)
-    fc = pd.concat(dfs_fc, axis=0).reset_index(drop=True)
-
-    full = pd.merge(rt, fc, on=['STUDENT_ID'], how='outer')
-
-    df_insert = full[['STUDENT_ID', 'LAT', 'LON', 'DT', 'AQI_CURRENT',
-                      'AQI_TODAY', 'AQI_NEXT_DAY']]
-
-    
-    try:
-        df_insert.to_sql('daily_mycap', con=extractor.sqlach_engine, if_exists='append', index=False)
-        extractor.logger.info('Successfully inserted data into Database')
-    except Exception as exp:
-        extractor.logger.exception("Exception encountered: ", exp)
+    # OWM's api quota is enforced by the extractor's rate limiter
+    rt, fc = await asyncio.gather(extractor.get_rt(student_ids),
+                                  extractor.get_fc(student_ids))
+
+    extractor.logger.info("Merging DataFrames")
+    # get_rt/get_fc return None when every request on their side failed; students without a current reading
+    # keep their registered coordinates and are stamped with the run's start time
+    run_dt = pd.Timestamp(int(t0), unit='s', tz='UTC').tz_convert(CONFIGS['main']['timezone'])
+    if rt is None and fc is None:
+        full = None
+    elif rt is None:
+        full = fc.assign(LAT=fc['STUDENT_ID'].map(lambda id: extractor.students_dict[id]['LAT']),
+                         LON=fc['STUDENT_ID'].map(lambda id: extractor.students_dict[id]['LON']),
+                         DT=run_dt,
+                         AQI_CURRENT=np.nan)
+    elif fc is None:
+        full = rt.assign(AQI_TODAY=np.nan, AQI_NEXT_DAY=np.nan)
+    # rt and fc are built in the same student order, so they only need a join when a request failed for one of them
+    elif np.array_equal(rt['STUDENT_ID'].to_numpy(), fc['STUDENT_ID'].to_numpy()):
+        full = rt.copy()
+        full['AQI_TODAY'] = fc['AQI_TODAY'].to_numpy()
+        full['AQI_NEXT_DAY'] = fc['AQI_NEXT_DAY'].to_numpy()
+    else:
+        full = pd.merge(rt, fc, on=['STUDENT_ID'], how='outer')
+        no_rt = full['DT'].isna()
+        full.loc[no_rt, 'LAT'] = full.loc[no_rt, 'STUDENT_ID'].map(lambda id: extractor.students_dict[id]['LAT'])
+        full.loc[no_rt, 'LON'] = full.loc[no_rt, 'STUDENT_ID'].map(lambda id: extractor.students_dict[id]['LON'])
+        full.loc[no_rt, 'DT'] = run_dt
+
+    if full is None:
+        extractor.logger.error('No AQI could be retrieved for any student, nothing to insert into Database')
+    else:
+        df_insert = full[['STUDENT_ID', 'LAT', 'LON', 'DT', 'AQI_CURRENT',
+                          'AQI_TODAY', 'AQI_NEXT_DAY']]
+
+        try:
+            df_insert.to_sql('daily_mycap', con=extractor.sqlach_engine, if_exists='append', index=False,
+                             method='multi', chunksize=500)
+            extractor.logger.info('Successfully inserted data into Database')
+        except Exception as exp:
+            extractor.logger.exception("Exception encountered: ", exp)
 
     extractor.db.commit()
 
@@ -62,6 +84,10 @@ def main():
     extractor.logger.info(f'Could not retrieve current AQI for {extractor.fc_error_list}')
     extractor.logger.info(f'Extraction ended at {t1}')
     extractor.logger.info(f'Execution time: {t1 - t0}')
+
+
+def main():
+    asyncio.run(main_async())
     
 
 